@@ -5,5 +5,5 @@ nohup ./tapo-rest /app/devices.json --port=80 &
 # Wait a few seconds to ensure tapo-rest is up
 sleep 2
 
-# Start the waitress server
-exec waitress-serve --host=0.0.0.0 --port=5000 taposc:app
+# Start the waitress server, with enough threads to serve several dashboards at once
+exec waitress-serve --host=0.0.0.0 --port=5000 --threads=8 taposc:app
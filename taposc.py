@@ -1,11 +1,37 @@
 from flask import Flask, jsonify, redirect, url_for
+from flask.json.provider import JSONProvider
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import os
 import logging
+import atexit
+import copy
+import functools
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
 
 # --- Flask App Setup ---
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson, used by jsonify() for all responses."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Skip the bytes -> str -> bytes round trip of the default implementation
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -13,9 +39,79 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # --- Global Variables for Configuration and State ---
 TAPO_API_URL = None
 AUTH_TOKEN = None
-DEVICES_LIST = []
+# (devices list, subtraction plan), always replaced together. Plan entries are
+# (device_name, device_to_subtract_name, device_index, device_to_subtract_index), in devices.json order
+DEVICES = ([], [])
 INITIALIZATION_ERROR = None
 LOGIN_PASSWORD = None
+DEVICES_FILE_MTIME = None  # Modification time of devices.json when it was last loaded
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE_PATH = os.path.join(SCRIPT_DIR, "app", "config.json")
+DEVICES_FILE_PATH = os.path.join(SCRIPT_DIR, "app", "devices.json")
+
+# --- HTTP Session Setup ---
+# Maximum number of device queries in flight. The thread pool and the connection
+# pool are sized from the number of devices, up to this limit (see size_for_devices())
+MAX_CONCURRENT_REQUESTS = 32
+# Separate connect and read timeouts, so an unreachable tapo-rest fails fast
+REQUEST_TIMEOUT = (1.5, 5)  # seconds
+# Upper bound on the time spent waiting for all device queries of one refresh.
+# With more than MAX_CONCURRENT_REQUESTS devices, later queries wait for a free worker
+# and can be reported as "deadline exceeded" behind a slow device.
+FETCH_DEADLINE = 7  # seconds
+
+# --- Last Good Reading Setup ---
+# After a failed query the last good reading is served, flagged as stale, for at most this long
+STALE_MAX_AGE = 60  # seconds
+_last_good_results = {}  # (device_name, device_type) -> (timestamp, result serialized with orjson)
+_last_good_results_lock = threading.Lock()
+
+# --- Circuit Breaker Setup ---
+# Devices failing repeatedly are skipped for a while instead of costing a timeout on every refresh
+BREAKER_THRESHOLD = 3  # consecutive failures
+BREAKER_WINDOW = 60  # seconds in which the failures must occur
+BREAKER_COOLDOWN = 30  # seconds during which the device is skipped
+_breaker = {}  # device_name -> (fail_count, first_failure_time, open_until, last_error)
+_breaker_lock = threading.Lock()
+
+# --- Conditional Request Setup ---
+# If tapo-rest sends an ETag, the last body is kept so unchanged readings can be answered with 304
+_etags = {}  # (device_name, device_type) -> (etag, data)
+_etags_lock = threading.Lock()
+
+# A shared session keeps connections to tapo-rest alive between requests.
+# tapo-rest is reached over plain HTTP/1.1 (usually on localhost), so an HTTP/2
+# client would not multiplex anything here: it is only negotiated over TLS.
+SESSION = requests.Session()
+
+# --- Thread Pool for Concurrent Device Queries ---
+# Device queries are independent network calls, so they are run concurrently
+EXECUTOR = None
+EXECUTOR_SIZE = 0
+
+def size_for_devices(device_count):
+    """
+    Sizes the thread pool and the session's connection pool so that all devices
+    can be queried at once, up to MAX_CONCURRENT_REQUESTS. Pools are only ever grown.
+    """
+    global EXECUTOR, EXECUTOR_SIZE
+
+    size = min(MAX_CONCURRENT_REQUESTS, max(1, device_count))
+    if size <= EXECUTOR_SIZE:
+        return
+
+    adapter = HTTPAdapter(
+        pool_connections=1,  # All requests go to the single tapo-rest host
+        pool_maxsize=size,
+        # Only retry failed connections: retrying read timeouts would let one query outlast REQUEST_TIMEOUT
+        max_retries=Retry(total=2, read=False, backoff_factor=0.2)
+    )
+    SESSION.mount('http://', adapter)
+    SESSION.mount('https://', adapter)
+    # A replaced pool finishes its queued queries, and its idle workers exit once it is no longer referenced
+    EXECUTOR = ThreadPoolExecutor(max_workers=size)
+    EXECUTOR_SIZE = size
 
 # --- Login and get token ---
 def login_tapo_rest():
@@ -26,15 +122,16 @@ def login_tapo_rest():
     token = None
     
     try:
-        response = requests.post(login_url, headers=login_headers, json=login_payload)
+        response = SESSION.post(login_url, headers=login_headers, json=login_payload, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
         
         token = response.text.strip()
         
         if not token:
             print(f"Error: Login token is empty. Raw response: '{response.text}'")
-            exit()
-        logging.info(f"Login successful. Token: {token}")
+            return
+        logging.info("Login successful. Token: %s", token)
+        SESSION.headers["Authorization"] = f"Bearer {token}"
         return token
         
     except requests.exceptions.HTTPError as http_err:
@@ -52,16 +149,55 @@ def login_tapo_rest():
         print(f"Error during login: {req_err}")
         return
 
+# --- Lazily Obtain and Refresh the Token ---
+LOGIN_RETRY_DELAY = 10  # seconds to wait after a failed login before trying again
+_token_lock = threading.Lock()
+_login_attempts = 0  # Incremented on every login, so waiting threads can tell one happened
+_last_login_failure = None  # time.monotonic() of the last failed login
+
+def get_auth_token():
+    """
+    Returns the current auth token, logging in to tapo-rest first if needed.
+    Threads that waited on another thread's login reuse its result, and no new
+    login is attempted for LOGIN_RETRY_DELAY seconds after a failed one.
+    """
+    global AUTH_TOKEN, _login_attempts, _last_login_failure
+
+    if AUTH_TOKEN:
+        return AUTH_TOKEN
+    attempts_seen = _login_attempts
+    with _token_lock:
+        if AUTH_TOKEN or _login_attempts != attempts_seen: # Another thread logged in, or tried to, while we waited
+            return AUTH_TOKEN
+        if _last_login_failure is not None and time.monotonic() - _last_login_failure < LOGIN_RETRY_DELAY:
+            return None
+
+        _login_attempts += 1
+        AUTH_TOKEN = login_tapo_rest()
+        _last_login_failure = None if AUTH_TOKEN else time.monotonic()
+    return AUTH_TOKEN
+
+def invalidate_auth_token(rejected_token):
+    """Drops the token rejected by tapo-rest so the next call logs in again."""
+    global AUTH_TOKEN
+
+    with _token_lock:
+        if AUTH_TOKEN == rejected_token: # Skip if another thread already replaced it
+            AUTH_TOKEN = None
+
 # --- Helper Function to Load JSON Files ---
-def load_json_file(file_path, description="file"):
-    """Loads a JSON file and returns its content or an error message."""
+# Matches a "//" comment on the first line, which devices.json may contain
+LEADING_COMMENT_RE = re.compile(r'\A\s*//[^\n]*')
+
+def load_json_file(file_path, description="file", allow_leading_comment=False):
+    """
+    Loads a JSON file and returns its content or an error message.
+    If allow_leading_comment is set, a "//" comment on the first line is ignored.
+    The parsed content is reused until the file's modification time changes.
+    """
     try:
-        with open(file_path, 'r') as f:
-            if "devices.json" in file_path: # Specific handling for potential comment in devices.json
-                first_line = f.readline()
-                if not first_line.strip().startswith("//"):
-                    f.seek(0)
-            return json.load(f), None
+        mtime = os.stat(file_path).st_mtime_ns
+        return _load_json_cached(file_path, mtime, allow_leading_comment), None
     except FileNotFoundError:
         return None, f"Error: {description.capitalize()} file not found at {file_path}"
     except json.JSONDecodeError:
@@ -69,15 +205,24 @@ def load_json_file(file_path, description="file"):
     except Exception as e:
         return None, f"An unexpected error occurred while reading {file_path}: {e}"
 
-# --- Initialization Functions (called once at startup) ---
+@functools.lru_cache(maxsize=8)
+def _load_json_cached(file_path, mtime, allow_leading_comment):
+    """
+    Parses a JSON file. The mtime argument only serves as part of the cache key.
+    Errors are raised rather than returned, so that only successful parses are cached.
+    """
+    with open(file_path, 'r') as f:
+        text = f.read()
+    if allow_leading_comment:
+        text = LEADING_COMMENT_RE.sub('', text, count=1)
+    return orjson.loads(text)
+
+# --- Initialization Functions (called on the first request) ---
 def load_configuration():
     """Loads tapo_api_url and auth_token from config.json."""
     global TAPO_API_URL, AUTH_TOKEN, INITIALIZATION_ERROR, LOGIN_PASSWORD
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    config_file_path = os.path.join(script_dir, "app", "config.json")
-    
-    config_data_loaded, error = load_json_file(config_file_path, "config")
+    config_data_loaded, error = load_json_file(CONFIG_FILE_PATH, "config")
     if error:
         INITIALIZATION_ERROR = error
         logging.error(INITIALIZATION_ERROR)
@@ -93,57 +238,197 @@ def load_configuration():
     else:
         logging.info("Configuration loaded successfully.")
 
+def read_devices():
+    """
+    Reads devices.json and returns ((devices list, subtraction plan), None),
+    or (None, error message) if the file cannot be used.
+    """
+    devices_data_loaded, error = load_json_file(DEVICES_FILE_PATH, "devices", allow_leading_comment=True)
+    if error:
+        return None, error
+    
+    # Build the new list and plan in locals, so that callers can publish both at once and a
+    # refresh never sees a list without its precomputed fields or a plan built for another list.
+    # Entries are copied because the parsed file content is shared through the JSON cache.
+    devices_list = [dict(device_info) for device_info in devices_data_loaded.get("devices", [])]
+    if not devices_list:
+        return None, "No devices found in devices.json or the 'devices' key is missing/empty."
+    logging.info("Loaded %d device(s) from devices.json.", len(devices_list))
+
+    # Precompute the request URL and params, which never change for a device
+    for device_info in devices_list:
+        device_name = device_info.get("name")
+        device_type = device_info.get("device_type")
+        if device_name and device_type:
+            device_info["_power_url"] = f"{TAPO_API_URL}/actions/{device_type.lower()}/get-current-power"
+            device_info["_params"] = {'device': device_name}
+        else:
+            logging.warning("Device entry will be skipped due to missing 'name' or 'device_type': %s", device_info)
+
+    # Only devices with a "substract" field take part in the subtraction pass.
+    # Positions in the list are resolved once, as results are returned in the same order.
+    name_to_index = {device_info["name"]: index for index, device_info in enumerate(devices_list)
+                     if device_info.get("name") and device_info.get("device_type")}
+    subtraction_plan = []
+    for device_info in devices_list:
+        device_name = device_info.get("name")
+        subtract_device_name = device_info.get("substract")
+        if device_name and subtract_device_name:
+            if subtract_device_name not in name_to_index:
+                logging.warning("Device to subtract '%s' for '%s' is not a valid device in devices.json", subtract_device_name, device_name)
+            subtraction_plan.append((device_name, subtract_device_name,
+                                     name_to_index.get(device_name), name_to_index.get(subtract_device_name)))
+
+    return (devices_list, subtraction_plan), None
+
 def load_devices():
     """Loads the list of devices from devices.json."""
-    global DEVICES_LIST, INITIALIZATION_ERROR
+    global DEVICES, INITIALIZATION_ERROR, DEVICES_FILE_MTIME
 
     if INITIALIZATION_ERROR: return
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    devices_file_path = os.path.join(script_dir, "app", "devices.json")
+    try:
+        DEVICES_FILE_MTIME = os.stat(DEVICES_FILE_PATH).st_mtime_ns
+    except OSError:
+        DEVICES_FILE_MTIME = None
 
-    devices_data_loaded, error = load_json_file(devices_file_path, "devices")
+    devices, error = read_devices()
     if error:
         INITIALIZATION_ERROR = error
         logging.error(INITIALIZATION_ERROR)
         return
-    
-    DEVICES_LIST = devices_data_loaded.get("devices", [])
-    if not DEVICES_LIST:
-        INITIALIZATION_ERROR = "No devices found in devices.json or the 'devices' key is missing/empty."
-        logging.error(INITIALIZATION_ERROR)
-    else:
-        logging.info(f"Loaded {len(DEVICES_LIST)} device(s) from devices.json.")
+    DEVICES = devices
+
+# --- Perform Initialization (on the first request) ---
+# Nothing is loaded at import time, so the server starts even if a file is missing.
+# Login happens lazily on the first device query, see get_auth_token()
+_INITIALIZED = False
+_init_lock = threading.Lock()
+
+@app.before_request
+def ensure_initialized():
+    """Loads config.json and devices.json and starts the refresher, retrying on every request until it succeeds."""
+    global INITIALIZATION_ERROR, _INITIALIZED
+
+    if _INITIALIZED:
+        return
+    with _init_lock:
+        if _INITIALIZED: # Another request may have initialized already
+            return
+        INITIALIZATION_ERROR = None
+        load_configuration()
+        load_devices()
+        if INITIALIZATION_ERROR:
+            return
+
+        size_for_devices(len(DEVICES[0]))
+        _store_snapshot() # The first request is answered from this, not from a query of its own
+        threading.Thread(target=_refresher, name="device-refresher", daemon=True).start()
+        atexit.register(_stop_refresher.set)
+        _INITIALIZED = True
 
-# --- Perform Initialization ---
-load_configuration()
-if not INITIALIZATION_ERROR:
-    AUTH_TOKEN = login_tapo_rest()
-    load_devices()
+# --- Reload devices.json When It Changes ---
+_devices_reload_lock = threading.Lock()
 
+@app.before_request
+def reload_devices_if_changed():
+    """
+    Reloads devices.json before a request if it was edited since it was last loaded.
+    If the edited file cannot be used, the previously loaded devices are kept.
+    """
+    global DEVICES, DEVICES_FILE_MTIME
+
+    if not _INITIALIZED: # ensure_initialized() keeps retrying the full load until it succeeds
+        return
+    try:
+        mtime = os.stat(DEVICES_FILE_PATH).st_mtime_ns
+    except OSError:
+        return
+    if mtime == DEVICES_FILE_MTIME:
+        return
+
+    with _devices_reload_lock:
+        if mtime != DEVICES_FILE_MTIME: # Another request may have reloaded it already
+            logging.info("devices.json changed, reloading devices.")
+            DEVICES_FILE_MTIME = mtime
+            devices, error = read_devices()
+            if error:
+                logging.error("Keeping the previously loaded devices: %s", error)
+                return
+            size_for_devices(len(devices[0]))
+            DEVICES = devices # The snapshot built for the old devices is no longer current, see _snapshot_is_current()
+
+# --- Circuit Breaker Helpers ---
+def _breaker_is_open(device_name):
+    """Returns the last error for a device that is currently being skipped, or None."""
+    with _breaker_lock:
+        entry = _breaker.get(device_name)
+    if entry and time.monotonic() < entry[2]:
+        return entry[3]
+    return None
+
+def _record_failure(device_name, error):
+    """Counts a failed query and opens the breaker once BREAKER_THRESHOLD is reached."""
+    now = time.monotonic()
+    with _breaker_lock:
+        fail_count, first_failure_time, open_until, _ = _breaker.get(device_name, (0, now, 0, None))
+        if now - first_failure_time > BREAKER_WINDOW: # Older failures no longer count
+            fail_count, first_failure_time = 0, now
+        fail_count += 1
+        if fail_count >= BREAKER_THRESHOLD:
+            open_until = now + BREAKER_COOLDOWN
+            logging.warning("%s failed %d times, skipping it for %d seconds", device_name, fail_count, BREAKER_COOLDOWN)
+        _breaker[device_name] = (fail_count, first_failure_time, open_until, error)
+
+def _record_success(device_name):
+    """Closes the breaker for a device that answered successfully."""
+    with _breaker_lock:
+        _breaker.pop(device_name, None)
 
 # --- API Call Function with Simplified Error Handling ---
-def fetch_device_power_data_with_auth(device_name, device_type):
+def fetch_device_power_data_with_auth(device_info, retry_on_auth_error=True):
     """
-    Fetches power data from the Tapo API using the pre-configured auth token.
+    Fetches power data for a device entry prepared by load_devices(),
+    using the current auth token.
+    If the token is rejected, logs in again and retries once.
     Error handling is simplified.
     """
-    if not AUTH_TOKEN:
-        return {"device": device_name, "error": "Authentication token not available.", "status": "failed"}
+    device_name = device_info["name"]
+    last_error = _breaker_is_open(device_name)
+    if last_error:
+        return {"device": device_name, "error": "Device temporarily unavailable", "details": last_error, "status": "failed"}
 
-    device_type_lower = device_type.lower()
-    power_url = f"{TAPO_API_URL}/actions/{device_type_lower}/get-current-power"
-    params = {'device': device_name}
-    power_headers = {"Authorization": f"Bearer {AUTH_TOKEN}"}    
+    token = get_auth_token()
+    if not token:
+        return {"device": device_name, "error": "Authentication token not available.", "status": "failed"}
     
+    key = (device_name, device_info["device_type"])
+    with _etags_lock:
+        etag_entry = _etags.get(key)
+    conditional_headers = {"If-None-Match": etag_entry[0]} if etag_entry else None
+
     try:
-        response = requests.get(power_url, headers=power_headers, params=params, timeout=10)
+        # The Authorization header is set on the session after login
+        response = SESSION.get(device_info["_power_url"], headers=conditional_headers,
+                               params=device_info["_params"], timeout=REQUEST_TIMEOUT)
         response.raise_for_status()  # Raises HTTPError for 4xx/5xx responses
-        current_power_data = response.json() # Raises ValueError/JSONDecodeError for invalid JSON
+
+        if response.status_code == 304 and etag_entry:
+            # Unchanged since the last reading, callers may modify the data so hand out a copy
+            _record_success(device_name)
+            return {"device": device_name, "data": copy.deepcopy(etag_entry[1]), "status": "success"}
+
+        current_power_data = orjson.loads(response.content) # Raises JSONDecodeError for invalid JSON
+        etag = response.headers.get("ETag")
+        if etag:
+            with _etags_lock:
+                _etags[key] = (etag, copy.deepcopy(current_power_data))
         
         # Debug logging for API response structure
-        logging.debug(f"API response for {device_name}: {json.dumps(current_power_data, indent=2)}")
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("API response for %s: %s", device_name, orjson.dumps(current_power_data, option=orjson.OPT_INDENT_2).decode())
         
+        _record_success(device_name)
         return {"device": device_name, "data": current_power_data, "status": "success"}
     
     except requests.exceptions.HTTPError as http_err:
@@ -153,103 +438,148 @@ def fetch_device_power_data_with_auth(device_name, device_type):
         if http_err.response is not None:
             status_code = http_err.response.status_code
             error_text = http_err.response.text[:200] # Limit error text length
-        logging.error(f"HTTPError for {device_name}: {status_code} - {http_err}") # Log full error
+        if status_code == 401 and retry_on_auth_error:
+            logging.warning("Auth token rejected for %s, logging in again", device_name)
+            invalidate_auth_token(token)
+            return fetch_device_power_data_with_auth(device_info, retry_on_auth_error=False)
+        logging.error("HTTPError for %s: %s - %s", device_name, status_code, http_err) # Log full error
+        _record_failure(device_name, f"HTTP error {status_code}")
         return {"device": device_name, "error": f"HTTP error {status_code}", "details": error_text, "status": "failed"}
 
     except requests.exceptions.RequestException as req_err:
         # Catches other request-related errors (ConnectionError, Timeout, etc.)
-        logging.error(f"RequestException for {device_name}: {req_err}") # Log full error
+        logging.error("RequestException for %s: %s", device_name, req_err) # Log full error
+        _record_failure(device_name, f"Request failed: {type(req_err).__name__}")
         return {"device": device_name, "error": f"Request failed: {type(req_err).__name__}", "status": "failed"}
     
-    except (ValueError, json.JSONDecodeError) as json_err: # Handles errors from response.json()
-        logging.error(f"JSONDecodeError for {device_name}: {json_err}") # Log full error
+    except (ValueError, json.JSONDecodeError) as json_err: # Handles errors from orjson.loads()
+        logging.error("JSONDecodeError for %s: %s", device_name, json_err) # Log full error
         return {"device": device_name, "error": "Invalid JSON response from API.", "status": "failed"}
         
     except Exception as e: # Catch any other unexpected error
-        logging.error(f"Unexpected error for {device_name}: {e}", exc_info=True) # Log full error with traceback
+        logging.error("Unexpected error for %s: %s", device_name, e, exc_info=True) # Log full error with traceback
         return {"device": device_name, "error": f"An unexpected error occurred: {type(e).__name__}", "status": "failed"}
 
 
-# --- Flask API Endpoint ---
-@app.route('/get_all_device_power', methods=['GET'])
-def get_all_device_power():
+# --- Wrapper Around the API Call Falling Back to the Last Good Reading ---
+def get_device_power_with_fallback(device_info):
+    """
+    Returns power data for a device. If the device query fails, the last
+    successful result is returned flagged as stale, unless it is older than
+    STALE_MAX_AGE.
     """
-    Flask endpoint. Queries power data for configured devices.
+    key = (device_info["name"], device_info["device_type"])
+    result = fetch_device_power_data_with_auth(device_info)
+    if result.get("status") == "success":
+        # Stored serialized: the subtraction pass modifies the result in place,
+        # and orjson is cheaper than a deep copy
+        with _last_good_results_lock:
+            _last_good_results[key] = (time.monotonic(), orjson.dumps(result))
+        return result
+
+    with _last_good_results_lock:
+        last_good = _last_good_results.get(key)
+    if last_good and time.monotonic() - last_good[0] < STALE_MAX_AGE:
+        logging.warning("Serving stale data for %s: %s", device_info["name"], result.get('error'))
+        stale_result = orjson.loads(last_good[1])
+        stale_result["stale"] = True
+        return stale_result
+    return result
+
+
+# --- Helper Function to Locate current_power in a Response ---
+def _extract_power(data):
+    """
+    Returns (current_power, setter) for a device response, checking
+    data["result"]["current_power"] first, then data["current_power"].
+    Returns (None, None) if neither is present.
+    """
+    result = data.get("result")
+    if isinstance(result, dict) and "current_power" in result:
+        return result["current_power"], lambda value: result.__setitem__("current_power", value)
+    if "current_power" in data:
+        return data["current_power"], lambda value: data.__setitem__("current_power", value)
+    return None, None
+
+
+# --- Helper Function to Look Up a Device's Result ---
+def _result_for(results, index):
+    """Returns the result at a subtraction plan index, or None for a device that was not queried."""
+    if index is None:
+        return None
+    return results[index]
+
+
+# --- Query All Devices and Apply Subtractions ---
+def fetch_all_device_power(devices_state):
+    """
+    Queries power data for the (devices list, subtraction plan) loaded from devices.json.
     If a device has a "substract" field, its value (name of another device)
     will have its power subtracted from the current device's power.
     """
-    if INITIALIZATION_ERROR:
-        logging.error(f"API call failed due to initialization error: {INITIALIZATION_ERROR}")
-        return jsonify({"error": "Server initialization failed. Check logs.", "details": INITIALIZATION_ERROR}), 500
-        
-    results = []
-    for device_info in DEVICES_LIST:
+    devices, subtraction_plan = devices_state
+    executor = EXECUTOR
+    results = [None] * len(devices)
+    futures = {}
+    for index, device_info in enumerate(devices):
         device_name = device_info.get("name")
         device_type = device_info.get("device_type")
 
         if not device_name or not device_type:
-            logging.warning(f"Skipping device due to missing 'name' or 'device_type': {device_info}")
-            results.append({
+            logging.debug("Skipping device due to missing 'name' or 'device_type': %s", device_info)
+            results[index] = {
                 "device_info": device_info, 
                 "error": "Missing 'name' or 'device_type' in devices.json entry", 
                 "status": "skipped"
-            })
+            }
             continue
         
-        result = fetch_device_power_data_with_auth(device_name, device_type)
-        results.append(result)
+        futures[executor.submit(get_device_power_with_fallback, device_info)] = index
+
+    # Collect results as they complete, keeping the order from devices.json
+    try:
+        for future in as_completed(futures, timeout=FETCH_DEADLINE):
+            results[futures[future]] = future.result()
+    except FuturesTimeoutError:
+        # Report devices that did not answer in time instead of waiting for them
+        for future, index in futures.items():
+            if results[index] is None:
+                future.cancel()
+                device_name = devices[index]["name"]
+                logging.warning("No response from %s within %s seconds", device_name, FETCH_DEADLINE)
+                results[index] = {"device": device_name, "error": "deadline exceeded", "status": "failed"}
     
     # Process subtractions after all device data is collected
-    # Create a device name to result mapping for easy lookup
-    results_by_name = {result.get("device"): result for result in results if result.get("device")}
-    
-    for device_info in DEVICES_LIST:
-        device_name = device_info.get("name")
-        subtract_device_name = device_info.get("substract")
-        
-        if subtract_device_name and device_name in results_by_name:
-            main_result = results_by_name[device_name]
+    for device_name, subtract_device_name, device_index, subtract_index in subtraction_plan:
+        main_result = _result_for(results, device_index)
+        if main_result is not None:
             
             # Skip if main device didn't get successful data
             if main_result.get("status") != "success" or "data" not in main_result:
-                logging.warning(f"Cannot apply subtraction for '{device_name}': No valid power data available")
+                logging.warning("Cannot apply subtraction for '%s': No valid power data available", device_name)
                 continue
                 
             # Check if subtracted device exists and has valid data
-            if subtract_device_name not in results_by_name:
-                logging.warning(f"Cannot apply subtraction for '{device_name}': Device '{subtract_device_name}' not found")
+            subtract_result = _result_for(results, subtract_index)
+            if subtract_result is None:
+                logging.warning("Cannot apply subtraction for '%s': Device '%s' not found", device_name, subtract_device_name)
                 main_result["data"]["subtraction_error"] = f"Device to subtract '{subtract_device_name}' not found"
                 continue
                 
-            subtract_result = results_by_name[subtract_device_name]
             if subtract_result.get("status") != "success" or "data" not in subtract_result:
-                logging.warning(f"Cannot apply subtraction for '{device_name}': No valid power data for '{subtract_device_name}'")
+                logging.warning("Cannot apply subtraction for '%s': No valid power data for '%s'", device_name, subtract_device_name)
                 main_result["data"]["subtraction_error"] = f"No valid power data for '{subtract_device_name}'"
                 continue
               # Get power values and subtract
             try:
                 # Debug logging to help understand the data structure
-                logging.debug(f"Main device data structure: {json.dumps(main_result.get('data', {}), indent=2)}")
-                logging.debug(f"Subtract device data structure: {json.dumps(subtract_result.get('data', {}), indent=2)}")
-                
-                # Check if the expected structure exists in the response
-                main_data = main_result.get("data", {})
-                subtract_data = subtract_result.get("data", {})
-                
-                # Try to get current_power from the response, handle different data structures
-                main_power = None
-                subtract_power = None
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("Main device data structure: %s", orjson.dumps(main_result.get('data', {}), option=orjson.OPT_INDENT_2).decode())
+                    logging.debug("Subtract device data structure: %s", orjson.dumps(subtract_result.get('data', {}), option=orjson.OPT_INDENT_2).decode())
                 
-                # Try different paths where current_power might be found
-                if "result" in main_data and "current_power" in main_data["result"]:
-                    main_power = main_data["result"]["current_power"]
-                elif "current_power" in main_data:
-                    main_power = main_data["current_power"]
-                
-                if "result" in subtract_data and "current_power" in subtract_data["result"]:
-                    subtract_power = subtract_data["result"]["current_power"]
-                elif "current_power" in subtract_data:
-                    subtract_power = subtract_data["current_power"]
+                # Get current_power once per device, wherever it is in the response
+                main_power, set_main_power = _extract_power(main_result.get("data", {}))
+                subtract_power, _ = _extract_power(subtract_result.get("data", {}))
                 
                 if main_power is None or subtract_power is None:
                     raise KeyError(f"Could not find current_power in the data. Main power found: {main_power is not None}, Subtract power found: {subtract_power is not None}")
@@ -258,12 +588,8 @@ def get_all_device_power():
                     original_power = main_power
                     adjusted_power = max(0, main_power - subtract_power)  # Ensure power doesn't go negative
                     
-                    # Update the power value 
-                    # Store at the same location where we found it
-                    if "result" in main_data and "current_power" in main_data["result"]:
-                        main_result["data"]["result"]["current_power"] = adjusted_power
-                    elif "current_power" in main_data:
-                        main_result["data"]["current_power"] = adjusted_power
+                    # Store the power value at the same location where we found it
+                    set_main_power(adjusted_power)
                     
                     # Add subtraction info
                     main_result["data"]["subtraction_info"] = {
@@ -272,18 +598,80 @@ def get_all_device_power():
                         "subtracted_power": subtract_power,
                         "adjusted_power": adjusted_power
                     }
-                    logging.info(f"Applied subtraction for '{device_name}': {original_power} - {subtract_power} = {adjusted_power}")
+                    if main_result.get("stale") or subtract_result.get("stale"):
+                        main_result["data"]["subtraction_info"]["stale"] = True
+                    logging.debug("Applied subtraction for '%s': %s - %s = %s", device_name, original_power, subtract_power, adjusted_power)
                 else:
-                    logging.warning(f"Cannot apply subtraction for '{device_name}': Power values not numeric")
+                    logging.warning("Cannot apply subtraction for '%s': Power values not numeric", device_name)
                     main_result["data"]["subtraction_error"] = "Power values not numeric"
             except KeyError as e:
-                logging.warning(f"Cannot apply subtraction for '{device_name}': Missing power data fields - {e}")
+                logging.warning("Cannot apply subtraction for '%s': Missing power data fields - %s", device_name, e)
                 main_result["data"]["subtraction_error"] = f"Missing power data fields: {e}"
             except Exception as e:
-                logging.error(f"Error applying subtraction for '{device_name}': {e}", exc_info=True)
+                logging.error("Error applying subtraction for '%s': %s", device_name, e, exc_info=True)
                 main_result["data"]["subtraction_error"] = f"Error during subtraction: {str(e)}"
 
-    return jsonify(results), 200
+    return results
+
+
+# --- Background Refresher Keeping a Snapshot of All Devices ---
+REFRESH_INTERVAL = 5  # seconds
+LATEST = None  # (generated_at, serialized results, DEVICES it was built from) from the most recent refresh
+_stop_refresher = threading.Event()
+_snapshot_lock = threading.Lock()
+
+def _build_snapshot():
+    """Queries all devices and serializes the results once, so every request can reuse them."""
+    devices = DEVICES
+    return time.time(), orjson.dumps(fetch_all_device_power(devices)), devices
+
+def _store_snapshot():
+    """Builds a new snapshot and publishes it as LATEST. Errors are logged and leave LATEST as is."""
+    global LATEST
+
+    try:
+        LATEST = _build_snapshot()
+    except Exception as e:
+        logging.error("Error refreshing device power data: %s", e, exc_info=True)
+
+def _refresher():
+    """Refreshes the LATEST snapshot every REFRESH_INTERVAL seconds until stopped."""
+    while not _stop_refresher.wait(REFRESH_INTERVAL):
+        if not INITIALIZATION_ERROR:
+            _store_snapshot()
+
+def _snapshot_is_current(snapshot):
+    """Tells whether a snapshot exists, matches the loaded devices and the refresher has not fallen behind."""
+    return (snapshot is not None and snapshot[2] is DEVICES
+            and time.time() - snapshot[0] <= 3 * REFRESH_INTERVAL)
+
+
+# --- Flask API Endpoint ---
+@app.route('/get_all_device_power', methods=['GET'])
+def get_all_device_power():
+    """
+    Flask endpoint. Returns the latest power data for configured devices,
+    as refreshed in the background. Queries the devices directly if no
+    recent snapshot is available.
+    """
+    if INITIALIZATION_ERROR:
+        logging.error("API call failed due to initialization error: %s", INITIALIZATION_ERROR)
+        return jsonify({"error": "Server initialization failed. Check logs.", "details": INITIALIZATION_ERROR}), 500
+
+    snapshot = LATEST
+    # Query directly if devices.json was reloaded or the refresher has fallen behind;
+    # one request does so for all waiting ones
+    if not _snapshot_is_current(snapshot):
+        with _snapshot_lock:
+            if not _snapshot_is_current(LATEST):
+                _store_snapshot()
+            snapshot = LATEST
+        if snapshot is None:
+            return jsonify({"error": "No device power data available. Check logs."}), 503
+
+    generated_at, body, _ = snapshot
+    return app.response_class(body, status=200, mimetype="application/json",
+                              headers={"X-Generated-At": str(generated_at)})
 
 # default route
 @app.route('/')
@@ -291,10 +679,10 @@ def default_route():
     return redirect(url_for('get_all_device_power'))
 
 # --- Run the Flask Development Server ---
+# In the Docker image the app is served by waitress (see start.sh).
+# Set FLASK_DEV=1 to enable the debugger and reloader when running this file directly.
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=bool(os.getenv('FLASK_DEV')))
     
-# Note: In production, consider using a WSGI server like Gunicorn or uWSGI instead of Flask's built-in server.
-# This is a development server and should not be used in production.
-# The debug=True flag is useful for development but should be set to False in production.
-# Note: Ensure that the TAPO_API_URL and AUTH_TOKEN are correctly set in config.json.
+# Note: The development server should not be used in production.
+# Note: Ensure that the TAPO_API_URL and LOGIN_PASSWORD are correctly set in config.json.